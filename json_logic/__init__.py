@@ -3,8 +3,10 @@
 from __future__ import unicode_literals
 
 import sys
-from six.moves import reduce
 import logging
+import marshal
+import threading
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,31 @@ def if_(*args):
         return None
 
 
+def and_(*args):
+    """Implements the 'and' operator, returning the first falsy argument."""
+    ret = True
+    for arg in args:
+        ret = arg
+        if not arg:
+            break
+    return ret
+
+
+def or_(*args):
+    """Implements the 'or' operator, returning the first truthy argument."""
+    ret = False
+    for arg in args:
+        ret = arg
+        if arg:
+            break
+    return ret
+
+
+def ternary(a, b, c):
+    """Implements the '?:' operator."""
+    return b if a else c
+
+
 def soft_equals(a, b):
     """Implements the '==' operator, which does type JS-style coertion."""
     if isinstance(a, str) or isinstance(b, str):
@@ -46,7 +73,10 @@ def hard_equals(a, b):
 
 def less(a, b, *args):
     """Implements the '<' operator with JS-style type coertion."""
-    types = set([type(a), type(b)])
+    if type(a) in (int, float) and type(b) in (int, float):
+        # Fast path: plain numbers need no coertion.
+        return a < b and (not args or less(b, *args))
+    types = (type(a), type(b))
     if float in types or int in types:
         try:
             a, b = float(a), float(b)
@@ -58,6 +88,8 @@ def less(a, b, *args):
 
 def less_or_equal(a, b, *args):
     """Implements the '<=' operator with JS-style type coertion."""
+    if type(a) in (int, float) and type(b) in (int, float):
+        return a <= b and (not args or less_or_equal(b, *args))
     return (
         less(a, b) or soft_equals(a, b)
     ) and (not args or less_or_equal(b, *args))
@@ -77,31 +109,69 @@ def to_numeric(arg):
 
 def plus(*args):
     """Sum converts either to ints or to floats."""
-    return sum(to_numeric(arg) for arg in args)
+    if len(args) == 2:
+        a, b = args
+        if type(a) in (int, float) and type(b) in (int, float):
+            # Fast path: plain numbers need no conversion.
+            return a + b
+    return sum(map(to_numeric, args))
+
+
+def multiply(*args):
+    """Product of the arguments, converted to floats."""
+    ret = 1
+    for arg in args:
+        ret *= float(arg)
+    return ret
 
 
 def minus(*args):
     """Also, converts either to ints or to floats."""
     if len(args) == 1:
         return -to_numeric(args[0])
-    return to_numeric(args[0]) - to_numeric(args[1])
+    a, b = args[0], args[1]
+    if type(a) in (int, float) and type(b) in (int, float):
+        return a - b
+    return to_numeric(a) - to_numeric(b)
+
+
+def in_(a, b):
+    """Implements the 'in' operator, for both lists and strings."""
+    return a in b if hasattr(b, "__contains__") else False
 
 
 def merge(*args):
     """Implements the 'merge' operator for merging lists."""
     ret = []
     for arg in args:
-        if isinstance(arg, list) or isinstance(arg, tuple):
-            ret += list(arg)
+        if isinstance(arg, (list, tuple)):
+            ret.extend(arg)
         else:
             ret.append(arg)
     return ret
 
 
+_var_paths = {}
+_VAR_PATHS_LIMIT = 1024
+
+
+def split_var_name(var_name):
+    """Splits a dot-notation variable name into its keys, memoized."""
+    var_name = str(var_name)
+    try:
+        return _var_paths[var_name]
+    except KeyError:
+        pass
+    if len(_var_paths) >= _VAR_PATHS_LIMIT:
+        _var_paths.clear()
+    path = _var_paths[var_name] = tuple(var_name.split('.'))
+    return path
+
+
 def get_var(data, var_name, not_found=None):
     """Gets variable value from data dictionary."""
     try:
-        for key in str(var_name).split('.'):
+        for key in split_var_name(var_name):
             try:
                 data = data[key]
             except TypeError:
@@ -141,7 +211,82 @@ def missing_some(data, min_required, args):
     return ret
 
 
-operations = {
+_data_operations = {
+    "var": get_var,
+    "missing": missing,
+    "missing_some": missing_some,
+}
+
+
+# The rules that jsonLogic() has compiled, keyed by their marshalled form,
+# from the least to the most recently used.
+_compiled_rules = OrderedDict()
+_COMPILED_RULES_LIMIT = 4096
+
+# The operations the compiled rules were compiled with and, if that isn't
+# an _Operations dict tracking its own changes, a copy to check it against.
+_compiled_operations = None
+_compiled_operations_copy = None
+
+# Guards the compiled rules. The generation counts how often they were
+# forgotten, so that a rule compiled meanwhile isn't kept.
+_compiled_rules_lock = threading.Lock()
+_compiled_rules_generation = 0
+
+
+def _forget_compiled_rules():
+    """Forgets the compiled rules, including those still being compiled."""
+    global _compiled_rules_generation
+    with _compiled_rules_lock:
+        _compiled_rules.clear()
+        _compiled_rules_generation += 1
+
+
+class _Operations(dict):
+    """The operations dict, which forgets the compiled rules on changes."""
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        _forget_compiled_rules()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _forget_compiled_rules()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        dict.clear(self)
+        _forget_compiled_rules()
+
+    def pop(self, *args):
+        try:
+            return dict.pop(self, *args)
+        finally:
+            _forget_compiled_rules()
+
+    def popitem(self):
+        try:
+            return dict.popitem(self)
+        finally:
+            _forget_compiled_rules()
+
+    def setdefault(self, *args):
+        try:
+            return dict.setdefault(self, *args)
+        finally:
+            _forget_compiled_rules()
+
+    def update(self, *args, **kwargs):
+        try:
+            dict.update(self, *args, **kwargs)
+        finally:
+            _forget_compiled_rules()
+
+
+operations = _Operations({
     "==": soft_equals,
     "===": hard_equals,
     "!=": lambda a, b: not soft_equals(a, b),
@@ -153,51 +298,642 @@ operations = {
     "!": lambda a: not a,
     "!!": bool,
     "%": lambda a, b: a % b,
-    "and": lambda *args: reduce(lambda total, arg: total and arg, args, True),
-    "or": lambda *args: reduce(lambda total, arg: total or arg, args, False),
-    "?:": lambda a, b, c: b if a else c,
+    "and": and_,
+    "or": or_,
+    "?:": ternary,
     "if": if_,
     "log": lambda a: logger.info(a) or a,
-    "in": lambda a, b: a in b if "__contains__" in dir(b) else False,
-    "cat": lambda *args: "".join(str(arg) for arg in args),
+    "in": in_,
+    "cat": lambda *args: "".join(map(str, args)),
     "+": plus,
-    "*": lambda *args: reduce(lambda total, arg: total * float(arg), args, 1),
+    "*": multiply,
     "-": minus,
     "/": lambda a, b=None: a if b is None else float(a) / float(b),
     "min": lambda *args: min(args),
     "max": lambda *args: max(args),
     "merge": merge,
-    "count": lambda *args: sum(1 if a else 0 for a in args),
-}
+    "count": lambda *args: sum(map(bool, args)),
+})
 
 
 def jsonLogic(tests, data=None):
-    """Executes the json-logic with given data."""
-    # You've recursed to a primitive, stop!
-    if tests is None or not isinstance(tests, dict):
+    """
+    Executes the json-logic with given data. Rules are compiled the first
+    time they are seen, so applying the same rule again is cheaper.
+    """
+    # You've got a primitive (or an empty object), stop!
+    if not isinstance(tests, dict) or not tests:
         return tests
+    return _compile_cached(tests)(data or {})
+
+
+def _copy_json(value):
+    """
+    Copies nested lists and dicts, as plain ones, sharing everything else.
+    Compiled rules hand out copies of their list and object literals, so
+    that changing one result can't change the results of other calls.
+    """
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _copy_json(item)) for key, item in value.items())
+    return value
+
+
+def _compile_call(operation, args):
+    """Compiles a call of the operation with all its arguments evaluated."""
+    # The common arities get flat calls, without an argument list to build
+    # and unpack on every evaluation.
+    if len(args) == 1:
+        arg, = args
+        return lambda data: operation(arg(data))
+    if len(args) == 2:
+        first, second = args
+        return lambda data: operation(first(data), second(data))
+    return lambda data: operation(*[arg(data) for arg in args])
+
+
+def _compile_data_call(operation, args):
+    """Like _compile_call, for operations that also take the data."""
+    if len(args) == 1:
+        arg, = args
+        return lambda data: operation(data, arg(data))
+    if len(args) == 2:
+        first, second = args
+        return lambda data: operation(data, first(data), second(data))
+    return lambda data: operation(data, *[arg(data) for arg in args])
+
+
+def _compile_get_var(var_name, not_found=None):
+    """
+    Compiles getting a variable from the data, like get_var(), with its
+    path split, and its keys converted to list indices, only once.
+    """
+    path = []
+    for key in split_var_name(var_name):
+        try:
+            index = int(key)
+        except ValueError:
+            index = None
+        path.append((key, index))
+
+    def var(data):
+        try:
+            for key, index in path:
+                try:
+                    data = data[key]
+                except TypeError:
+                    if index is None:
+                        return not_found
+                    data = data[index]
+        except (KeyError, TypeError, ValueError):
+            return not_found
+        return data
+
+    # Short paths without list indices are looked up directly, leaving
+    # anything but nested dicts to the loop above.
+    keys = [key for key, index in path if index is None]
+    if len(keys) != len(path):
+        return var
+    if len(keys) == 1:
+        key, = keys
+
+        def var_1(data):
+            try:
+                return data[key]
+            except KeyError:
+                return not_found
+            except (TypeError, ValueError):
+                return var(data)
+        return var_1
+    if len(keys) == 2:
+        first, second = keys
+
+        def var_2(data):
+            try:
+                return data[first][second]
+            except KeyError:
+                return not_found
+            except (TypeError, ValueError):
+                return var(data)
+        return var_2
+    if len(keys) == 3:
+        first, second, third = keys
+
+        def var_3(data):
+            try:
+                return data[first][second][third]
+            except KeyError:
+                return not_found
+            except (TypeError, ValueError):
+                return var(data)
+        return var_3
+    return var
+
+
+def _compile_var(values):
+    """Compiles 'var' with a constant name (and default)."""
+    if len(values) not in (1, 2):
+        return None
+    if len(values) == 2 and isinstance(values[1], (list, dict)):
+        get, default = _compile_get_var(values[0], _NOT_FOUND), values[1]
+
+        def var(data):
+            value = get(data)
+            return _copy_json(default) if value is _NOT_FOUND else value
+        return var
+    return _compile_get_var(*values)
+
+
+# What compiled variable lookups give for variables missing from the data.
+_NOT_FOUND = object()
+
+
+def _compile_missing(values):
+    """Compiles 'missing' with constant names."""
+    if values and isinstance(values[0], list):
+        values = values[0]
+    lookups = [
+        (name, _compile_get_var(name, _NOT_FOUND)) for name in values
+    ]
+    return lambda data: [
+        name for name, get in lookups if get(data) is _NOT_FOUND
+    ]
+
+
+def _compile_missing_some(values):
+    """Compiles 'missing_some' with a constant minimum and names."""
+    if len(values) != 2 or not isinstance(values[1], list):
+        return None
+    min_required, names = values
+    try:
+        if min_required < 1:
+            return lambda data: []
+    except TypeError:
+        # Left uncompiled, so the error surfaces on evaluation, not here.
+        return None
+    lookups = [(name, _compile_get_var(name, _NOT_FOUND)) for name in names]
+
+    def missing_some_logic(data):
+        found = 0
+        ret = []
+        for name, get in lookups:
+            if get(data) is _NOT_FOUND:
+                ret.append(name)
+            else:
+                found += 1
+                if found >= min_required:
+                    return []
+        return ret
+    return missing_some_logic
+
+
+# Compilers for the data operations whose arguments are all constant,
+# keyed like _lazy_operations. They return None when they don't apply.
+_constant_data_operations = {
+    get_var: _compile_var,
+    missing: _compile_missing,
+    missing_some: _compile_missing_some,
+}
+
+
+def _compile_if(args):
+    """Compiles 'if' so that only the taken branch is evaluated."""
+    pairs = [(args[i], args[i + 1]) for i in range(0, len(args) - 1, 2)]
+    otherwise = args[-1] if len(args) % 2 else (lambda data: None)
 
-    data = data or {}
+    def if_logic(data):
+        for condition, then in pairs:
+            if condition(data):
+                return then(data)
+        return otherwise(data)
+    return if_logic
 
-    operator = list(tests.keys())[0]
+
+def _compile_ternary(args):
+    """Compiles '?:' so that only the chosen value is evaluated."""
+    if len(args) != 3:
+        # Compiled as a plain call, so the arity error surfaces on evaluation.
+        return _compile_call(ternary, args)
+    condition, then, otherwise = args
+    return lambda data: then(data) if condition(data) else otherwise(data)
+
+
+def _compile_and(args):
+    """Compiles 'and' so that it stops at the first falsy argument."""
+    # Python's own 'and' gives the same value: the first falsy argument,
+    # or the last one.
+    if len(args) == 1:
+        return args[0]
+    if len(args) == 2:
+        first, second = args
+        return lambda data: first(data) and second(data)
+
+    def and_logic(data):
+        ret = True
+        for arg in args:
+            ret = arg(data)
+            if not ret:
+                break
+        return ret
+    return and_logic
+
+
+def _compile_or(args):
+    """Compiles 'or' so that it stops at the first truthy argument."""
+    if len(args) == 1:
+        return args[0]
+    if len(args) == 2:
+        first, second = args
+        return lambda data: first(data) or second(data)
+
+    def or_logic(data):
+        ret = False
+        for arg in args:
+            ret = arg(data)
+            if ret:
+                break
+        return ret
+    return or_logic
+
+
+# Compilers for the built-in operations that don't need all of their
+# arguments evaluated, keyed by the operation they replace so that
+# overriding an entry in operations still takes effect.
+_lazy_operations = {
+    if_: _compile_if,
+    ternary: _compile_ternary,
+    and_: _compile_and,
+    or_: _compile_or,
+}
+
+
+def _compile_in(compiled):
+    """Compiles 'in' with a constant list, to look values up in a set."""
+    if len(compiled) != 2:
+        return None
+    (item, _), (_, values) = compiled
+    if not isinstance(values, list):
+        return None
+    try:
+        members = frozenset(values)
+    except TypeError:
+        return None
+
+    def in_logic(data):
+        value = item(data)
+        try:
+            return value in members
+        except TypeError:
+            # Unhashable values, like lists, can still equal a member.
+            return value in values
+    return in_logic
+
+
+def _compile_soft_equals(compiled):
+    """Compiles '==' with a constant string, which is compared as a string."""
+    if len(compiled) != 2:
+        return None
+    (first, a), (second, b) = compiled
+    if type(b) is str:
+        item, value = first, b
+    elif type(a) is str:
+        item, value = second, a
+    else:
+        return None
+    return lambda data: str(item(data)) == value
+
+
+def _compile_hard_equals(compiled):
+    """Compiles '===' with a constant, so that its type is only found once."""
+    if len(compiled) != 2:
+        return None
+    (first, a), (second, b) = compiled
+    if b is not _VARIABLE:
+        item, value = first, b
+    elif a is not _VARIABLE:
+        item, value = second, a
+    else:
+        return None
+    kind = type(value)
+
+    def hard_equals_logic(data):
+        other = item(data)
+        return type(other) is kind and other == value
+    return hard_equals_logic
+
+
+# Compilers for the built-in operations that can be specialized when some
+# of their arguments are constant, keyed like _lazy_operations. They get
+# each argument's compiled function and value, and return None when they
+# don't apply.
+_specialized_operations = {
+    in_: _compile_in,
+    soft_equals: _compile_soft_equals,
+    hard_equals: _compile_hard_equals,
+}
+
+
+def _prune_if(compiled):
+    """
+    Drops the branches of 'if' behind constant falsy conditions, and
+    everything after a constant truthy one.
+    """
+    pruned = []
+    for i in range(0, len(compiled) - 1, 2):
+        condition, then = compiled[i], compiled[i + 1]
+        if condition[1] is _VARIABLE:
+            pruned.extend((condition, then))
+        elif condition[1]:
+            # The branches after this one can never be taken.
+            pruned.append(then)
+            return pruned
+    if len(pruned) == len(compiled) - len(compiled) % 2:
+        return None
+    if len(compiled) % 2:
+        pruned.append(compiled[-1])
+    else:
+        pruned.append(((lambda data: None), None))
+    return pruned
+
+
+def _prune_ternary(compiled):
+    """Picks the value of '?:' with a constant condition."""
+    if len(compiled) != 3 or compiled[0][1] is _VARIABLE:
+        return None
+    return [compiled[1] if compiled[0][1] else compiled[2]]
+
+
+def _prune_and(compiled):
+    """
+    Drops the arguments of 'and' after a constant falsy one, and the
+    constant truthy ones that aren't last.
+    """
+    pruned = []
+    for i, (func, value) in enumerate(compiled):
+        if value is _VARIABLE or i == len(compiled) - 1:
+            pruned.append((func, value))
+        elif not value:
+            pruned.append((func, value))
+            break
+    return pruned if len(pruned) < len(compiled) else None
+
+
+def _prune_or(compiled):
+    """
+    Drops the arguments of 'or' after a constant truthy one, and the
+    constant falsy ones that aren't last.
+    """
+    pruned = []
+    for i, (func, value) in enumerate(compiled):
+        if value is _VARIABLE or i == len(compiled) - 1:
+            pruned.append((func, value))
+        elif value:
+            pruned.append((func, value))
+            break
+    return pruned if len(pruned) < len(compiled) else None
+
+
+# Simplifiers for the lazy operations with some constant arguments, keyed
+# like _lazy_operations. They return the arguments that are left, just one
+# meaning that it gives the value of the whole operation, or None when
+# there's nothing to drop.
+_pruned_operations = {
+    if_: _prune_if,
+    ternary: _prune_ternary,
+    and_: _prune_and,
+    or_: _prune_or,
+}
+
+
+# The built-in operations that always give a bool, and can't fail unless
+# their arguments do, with the number of arguments they take.
+_boolean_operations = {
+    soft_equals: 2,
+    hard_equals: 2,
+    operations["!="]: 2,
+    operations["!=="]: 2,
+    operations["!"]: 1,
+    bool: 1,
+}
+
+
+def _safe_argument_cost(tests):
+    """
+    Like _safe_test_cost(), also allowing literals and 'var' lookups that
+    can't fail.
+    """
+    if not isinstance(tests, dict):
+        return 0
+    if len(tests) == 1 and "var" in tests:
+        values = tests["var"]
+        if not isinstance(values, (list, tuple)):
+            values = (values,)
+        if (len(values) in (1, 2) and isinstance(values[0], str)
+                and not any(isinstance(value, dict) for value in values)):
+            # Only list indices can fail, when they are out of range.
+            for key in split_var_name(values[0]):
+                try:
+                    int(key)
+                except ValueError:
+                    continue
+                return None
+            return 1
+        return None
+    return _safe_test_cost(tests)
+
+
+def _safe_test_cost(tests):
+    """
+    Estimates the cost of json-logic that gives a bool without side
+    effects or failures, as its number of operations, or returns None for
+    any other json-logic.
+    """
+    if not isinstance(tests, dict) or not tests:
+        return None
+    operator = next(iter(tests))
+    operation = operations.get(operator)
     values = tests[operator]
+    if not isinstance(values, (list, tuple)):
+        values = (values,)
+    if operation in _boolean_operations:
+        if len(values) != _boolean_operations[operation]:
+            return None
+        cost_of = _safe_argument_cost
+    elif operation is and_ or operation is or_:
+        cost_of = _safe_test_cost
+    else:
+        return None
+    cost = 1
+    for value in values:
+        value_cost = cost_of(value)
+        if value_cost is None:
+            return None
+        cost += value_cost
+    return cost
+
+
+def _order_by_cost(values, compiled):
+    """
+    Puts the cheapest arguments of 'and' or 'or' first, so that the
+    expensive ones are more often skipped. This is only done when all of
+    the arguments are safe tests, which give a bool, so that the order
+    can't change the result.
+    """
+    costs = [_safe_test_cost(value) for value in values]
+    if None in costs:
+        return compiled
+    order = sorted(range(len(compiled)), key=costs.__getitem__)
+    return [compiled[i] for i in order]
 
-    # Easy syntax for unary operators, like {"var": "x"} instead of strict
-    # {"var": ["x"]}
-    if not isinstance(values, list) and not isinstance(values, tuple):
-        values = [values]
 
-    # Recursion!
-    values = [jsonLogic(val, data) for val in values]
+# The built-in operations that have no side effects and always give the
+# same result for the same arguments, so can be evaluated when compiling.
+_pure_operations = frozenset(
+    operation for operator, operation in operations.items()
+    if operator != "log"
+)
 
-    if operator == 'var':
-        return get_var(data, *values)
-    if operator == 'missing':
-        return missing(data, *values)
-    if operator == 'missing_some':
-        return missing_some(data, *values)
+# Marks compiled logic whose value depends on the data.
+_VARIABLE = object()
 
-    if operator not in operations:
+
+def _fold(func):
+    """
+    Evaluates compiled logic that doesn't depend on the data once, and
+    returns a function giving that value along with the value itself.
+    Logic that fails, or gives a mutable value that callers could modify,
+    is left to be evaluated every time.
+    """
+    try:
+        value = func({})
+    except Exception:
+        return func, _VARIABLE
+    if isinstance(value, (list, dict)):
+        return func, _VARIABLE
+    return (lambda data: value), value
+
+
+def _compile(tests):
+    """
+    Compiles the json-logic into a function of the (normalized) data.
+    Returns the function and the logic's constant value, or _VARIABLE if
+    it depends on the data.
+    """
+    if not isinstance(tests, dict) or not tests:
+        if isinstance(tests, (list, dict)):
+            return (lambda data: _copy_json(tests)), tests
+        return (lambda data: tests), tests
+
+    operator = next(iter(tests))
+    values = tests[operator]
+    if not isinstance(values, (list, tuple)):
+        values = (values,)
+    compiled = [_compile(val) for val in values]
+    args = [func for func, _ in compiled]
+
+    operation = _data_operations.get(operator)
+    if operation is not None:
+        compiler = _constant_data_operations.get(operation)
+        if compiler is not None and all(
+                value is not _VARIABLE for _, value in compiled):
+            func = compiler([value for _, value in compiled])
+            if func is not None:
+                return func, _VARIABLE
+        return _compile_data_call(operation, args), _VARIABLE
+
+    operation = operations.get(operator)
+    if operation is None:
         raise ValueError("Unrecognized operation %s" % operator)
 
-    return operations[operator](*values)
+    if operation is and_ or operation is or_:
+        compiled = _order_by_cost(values, compiled)
+        args = [func for func, _ in compiled]
+
+    pruner = _pruned_operations.get(operation)
+    if pruner is not None:
+        pruned = pruner(compiled)
+        if pruned is not None:
+            if len(pruned) == 1:
+                return pruned[0]
+            compiled = pruned
+            args = [func for func, _ in compiled]
+
+    func = None
+    compiler = _specialized_operations.get(operation)
+    if compiler is not None:
+        func = compiler(compiled)
+    if func is None:
+        compiler = _lazy_operations.get(operation)
+        if compiler is not None:
+            func = compiler(args)
+        else:
+            func = _compile_call(operation, args)
+
+    if operation in _pure_operations and all(
+            value is not _VARIABLE for _, value in compiled):
+        return _fold(func)
+    return func, _VARIABLE
+
+
+def compile_logic(tests):
+    """
+    Compiles the json-logic into a function that executes it with given
+    data. The rule is only walked once, so this is faster than calling
+    jsonLogic() repeatedly with the same rule. Operations are looked up
+    at compile time.
+
+    'if', '?:', 'and' and 'or' only evaluate the arguments they need, like
+    json-logic-js does. Parts of the rule that don't depend on the data are
+    evaluated once, when compiling.
+    """
+    func, _ = _compile(tests)
+    return lambda data=None: func(data or {})
+
+
+def _compile_cached(tests):
+    """Compiles the json-logic, reusing the result for an equal rule."""
+    global _compiled_operations, _compiled_operations_copy
+    global _compiled_rules_generation
+    # Version 2 writes no back-references, which later versions add
+    # depending on reference counts, so equal rules get the same key.
+    try:
+        key = marshal.dumps(tests, 2)
+    except ValueError:
+        # Dict subclasses, like OrderedDict, are keyed as plain dicts.
+        try:
+            key = marshal.dumps(_copy_json(tests), 2)
+        except ValueError:
+            # The rule holds values that can't be marshalled, so isn't
+            # cached.
+            return _compile(tests)[0]
+    with _compiled_rules_lock:
+        if operations is not _compiled_operations or (
+                _compiled_operations_copy is not None
+                and operations != _compiled_operations_copy):
+            # operations was replaced, or is a plain dict that has changed.
+            _compiled_rules.clear()
+            _compiled_rules_generation += 1
+            _compiled_operations = operations
+            if isinstance(operations, _Operations):
+                _compiled_operations_copy = None
+            else:
+                _compiled_operations_copy = dict(operations)
+        func = _compiled_rules.pop(key, None)
+        if func is not None:
+            # Reinserting marks the rule as the most recently used.
+            _compiled_rules[key] = func
+            return func
+        generation = _compiled_rules_generation
+    # Compiles a copy, so that changing the rule later can't affect the
+    # cached function.
+    func, _ = _compile(marshal.loads(key))
+    with _compiled_rules_lock:
+        # Keeps the function unless the operations changed while compiling,
+        # as it may use the old ones.
+        if generation == _compiled_rules_generation:
+            if (key not in _compiled_rules
+                    and len(_compiled_rules) >= _COMPILED_RULES_LIMIT):
+                _compiled_rules.popitem(last=False)
+            _compiled_rules[key] = func
+    return func
@@ -3,13 +3,108 @@ Tests for jsonLogic.
 """
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import os
+import sys
+import tempfile
 import unittest
+from collections import OrderedDict
 try:
-    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
 except ImportError:
-    from urllib2 import urlopen
-from json_logic import jsonLogic
+    from urllib2 import HTTPError, Request, URLError, urlopen
+try:
+    # orjson decodes straight from bytes and is considerably faster.
+    from orjson import loads as _loads
+except ImportError:
+    def _loads(content):
+        return json.loads(content.decode('utf-8'))
+import json_logic
+from json_logic import compile_logic, jsonLogic, operations
+
+
+# Where the shared tests are kept between runs; JSON_LOGIC_TESTS_CACHE can
+# point it elsewhere, e.g. at a directory a CI job persists.
+CACHE_DIR = os.environ.get("JSON_LOGIC_TESTS_CACHE") or os.path.join(
+    os.path.expanduser("~"), ".cache", "json_logic_tests")
+
+
+def _write_atomically(path, content):
+    """Writes the bytes to path without ever exposing a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    getattr(os, 'replace', os.rename)(tmp_path, path)
+
+
+def _cached_fetch(url, download=True):
+    """
+    Fetches the url, keeping a copy on disk under CACHE_DIR. Once cached,
+    the url is only requested again when JSON_LOGIC_REFRESH_TESTS=1 is set
+    in the environment, and then revalidated with the server's
+    ETag/Last-Modified rather than downloaded again. The copy is also
+    used as is if the server can't be reached. Without download, returns
+    None rather than downloading a url that isn't cached yet.
+    """
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    body_path = os.path.join(CACHE_DIR, name + '.json')
+    headers_path = os.path.join(CACHE_DIR, name + '.headers')
+    cached = os.path.exists(body_path)
+    if not (cached or download):
+        return None
+    if cached and os.environ.get('JSON_LOGIC_REFRESH_TESTS') != '1':
+        with open(body_path, 'rb') as f:
+            return f.read()
+
+    request = Request(url)
+    if cached and os.path.exists(headers_path):
+        with open(headers_path, 'rb') as f:
+            for header, value in json.loads(f.read().decode('utf-8')).items():
+                request.add_header(header, value)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if not (cached and e.code == 304):
+            raise
+        response = None
+    except URLError:
+        if not cached:
+            raise
+        response = None
+    if response is None:
+        with open(body_path, 'rb') as f:
+            return f.read()
+
+    content = response.read()
+    info = response.info()
+    validators = {}
+    if info.get('ETag'):
+        validators['If-None-Match'] = info.get('ETag')
+    if info.get('Last-Modified'):
+        validators['If-Modified-Since'] = info.get('Last-Modified')
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    _write_atomically(body_path, content)
+    _write_atomically(headers_path, json.dumps(validators).encode('utf-8'))
+    return content
+
+
+_shared_tests = {}
+
+
+def load_shared_tests(url, download=True):
+    """
+    Fetches and parses the shared tests at url, once per process. Without
+    download, returns None if they haven't been downloaded yet.
+    """
+    if url not in _shared_tests:
+        content = _cached_fetch(url, download)
+        if content is None:
+            return None
+        _shared_tests[url] = _loads(content)
+    return _shared_tests[url]
 
 
 class JSONLogicTest(unittest.TestCase):
@@ -285,21 +380,24 @@ class JSONLogicTest(unittest.TestCase):
 
     def test_arithmetic(self):
         """Arithmetic operators."""
-        self.assertEqual(jsonLogic({"+": [1, 1]}), 2)
-        self.assertEqual(jsonLogic({"*": [2, 3]}), 6)
-        self.assertEqual(jsonLogic({"-": [3, 2]}), 1)
-        self.assertEqual(jsonLogic({"/": [2, 4]}), .5)
-        self.assertEqual(jsonLogic({"+": [1, 1]}), 2)
-        # Because addition and multiplication are associative,
-        # they happily take as many args as you want:
-        self.assertEqual(jsonLogic({"+": [1, 1, 1, 1, 1]}), 5)
-        self.assertEqual(jsonLogic({"*": [2, 2, 2, 2, 2]}), 32)
-        # Passing just one argument to - returns its arithmetic
-        # negative (additive inverse).
-        self.assertEqual(jsonLogic({"-": [2]}), -2)
-        self.assertEqual(jsonLogic({"-": [-2]}), 2)
-        # Passing just one argument to + casts it to a number.
-        self.assertEqual(jsonLogic({"+": "0"}), 0)
+        cases = (
+            ({"+": [1, 1]}, 2),
+            ({"*": [2, 3]}, 6),
+            ({"-": [3, 2]}, 1),
+            ({"/": [2, 4]}, .5),
+            # Because addition and multiplication are associative,
+            # they happily take as many args as you want:
+            ({"+": [1, 1, 1, 1, 1]}, 5),
+            ({"*": [2, 2, 2, 2, 2]}, 32),
+            # Passing just one argument to - returns its arithmetic
+            # negative (additive inverse).
+            ({"-": [2]}, -2),
+            ({"-": [-2]}, 2),
+            # Passing just one argument to + casts it to a number.
+            ({"+": "0"}, 0),
+        )
+        for logic, expected in cases:
+            self.assertEqual(jsonLogic(logic), expected, logic)
 
     def test_modulo(self):
         """
@@ -364,24 +462,403 @@ class JSONLogicTest(unittest.TestCase):
         """
         self.assertEqual(jsonLogic({"log": "apple"}), "apple")
 
+    def test_only_evaluates_needed_arguments(self):
+        # Dividing by zero would raise if it was ever evaluated.
+        fail = {"/": [1, 0]}
+        self.assertEqual(jsonLogic({"if": [True, "yes", fail]}), "yes")
+        self.assertEqual(jsonLogic({"and": [True, 0, fail]}), 0)
+        self.assertEqual(jsonLogic({"or": [False, "a", fail]}), "a")
+
+    def test_changed_rule_is_recompiled(self):
+        rule = {"in": [{"var": "a"}, ["x", "y"]]}
+        self.assertFalse(jsonLogic(rule, {"a": "z"}))
+        rule["in"][1].append("z")
+        self.assertTrue(jsonLogic(rule, {"a": "z"}))
+        self.assertFalse(jsonLogic({"in": [{"var": "a"}, ["x", "y"]]},
+                                   {"a": "z"}))
+
+    def test_results_are_not_shared_between_calls(self):
+        tags = jsonLogic({"var": ["tags", []]}, {})
+        tags.append("admin")
+        self.assertEqual(jsonLogic({"var": ["tags", []]}, {"user": 2}), [])
+        rule = {"if": [{"var": "a"}, [1, [2]], []]}
+        jsonLogic(rule, {"a": 1})[1].append(3)
+        self.assertEqual(jsonLogic(dict(rule), {"a": 1}), [1, [2]])
+
+    def test_replaced_operations_take_effect(self):
+        rule = {"+": [{"var": "a"}, 1]}
+        self.assertEqual(jsonLogic(rule, {"a": 1}), 2)
+        builtin = json_logic.operations
+        json_logic.operations = dict(builtin, **{"+": lambda *args: "new"})
+        try:
+            self.assertEqual(jsonLogic(rule, {"a": 1}), "new")
+            json_logic.operations["+"] = lambda *args: "newer"
+            self.assertEqual(jsonLogic(rule, {"a": 1}), "newer")
+        finally:
+            json_logic.operations = builtin
+        self.assertEqual(jsonLogic(rule, {"a": 1}), 2)
+
+    def test_equal_rules_are_compiled_once(self):
+        rule = {"==": [{"var": "a"}, 1]}
+        self.assertTrue(jsonLogic(rule, {"a": 1}))
+        cached = list(json_logic._compiled_rules)
+        # Holding on to parts of the rule doesn't change how it's keyed.
+        parts = rule["=="], rule["=="][0]
+        self.assertFalse(jsonLogic(rule, {"a": 2}))
+        self.assertTrue(jsonLogic({"==": [{"var": "a"}, 1]}, {"a": 1}))
+        self.assertEqual(list(json_logic._compiled_rules), cached)
+        # Equal but differently typed constants aren't confused.
+        self.assertFalse(jsonLogic({"===": [{"var": "a"}, 1]}, {"a": True}))
+        self.assertTrue(
+            jsonLogic({"===": [{"var": "a"}, True]}, {"a": True}))
+
+    def test_ordered_dict_rule_is_cached(self):
+        rule = json.loads(
+            '{"and": [{"var": "a"}, {"in": ["x", {"var": "b"}]}]}',
+            object_pairs_hook=OrderedDict)
+        self.assertTrue(jsonLogic(rule, {"a": 1, "b": "xy"}))
+        cached = list(json_logic._compiled_rules)
+        self.assertFalse(jsonLogic(rule, {"a": 1, "b": "y"}))
+        self.assertEqual(list(json_logic._compiled_rules), cached)
+
+    def test_least_recently_used_rule_is_evicted(self):
+        rules = [{"==": [{"var": "a"}, n]} for n in range(4)]
+        compiled = json_logic._compile_cached
+        limit = json_logic._COMPILED_RULES_LIMIT
+        json_logic._COMPILED_RULES_LIMIT = 3
+        try:
+            json_logic._compiled_rules.clear()
+            funcs = [compiled(rule) for rule in rules[:3]]
+            # A hit makes the rule the most recently used one, so adding
+            # another evicts the second rule rather than the first.
+            self.assertIs(compiled(rules[0]), funcs[0])
+            funcs.append(compiled(rules[3]))
+            self.assertEqual(len(json_logic._compiled_rules), 3)
+            self.assertIs(compiled(rules[0]), funcs[0])
+            self.assertIs(compiled(rules[2]), funcs[2])
+            self.assertIs(compiled(rules[3]), funcs[3])
+            self.assertIsNot(compiled(rules[1]), funcs[1])
+        finally:
+            json_logic._COMPILED_RULES_LIMIT = limit
+
+    def test_rule_compiled_while_operations_change_isnt_kept(self):
+        rule = {"double": [{"var": "a"}]}
+        compile_ = json_logic._compile
+
+        def compile_and_change(tests):
+            # Compiles the rule with the old operations, then changes them,
+            # as another thread could.
+            result = compile_(tests)
+            if tests == rule:
+                operations["double"] = lambda a: a * 2
+            return result
+
+        operations["double"] = lambda a: a * 3
+        json_logic._compile = compile_and_change
+        try:
+            self.assertEqual(jsonLogic(rule, {"a": 1}), 3)
+            json_logic._compile = compile_
+            self.assertEqual(jsonLogic(rule, {"a": 1}), 2)
+        finally:
+            json_logic._compile = compile_
+            del operations["double"]
+
+    def test_changed_operations_take_effect(self):
+        rule = {"double": [{"var": "a"}]}
+        self.assertRaises(ValueError, jsonLogic, rule, {"a": 2})
+        operations["double"] = lambda a: a * 2
+        try:
+            self.assertEqual(jsonLogic(rule, {"a": 2}), 4)
+            operations["double"] = lambda a: a + a + a
+            self.assertEqual(jsonLogic(rule, {"a": 2}), 6)
+        finally:
+            del operations["double"]
+        self.assertRaises(ValueError, jsonLogic, rule, {"a": 2})
+
+
+class CompileLogicTest(unittest.TestCase):
+    """Tests for compiling rules once and applying them to many data."""
+    def test_compiled_rule_is_reusable(self):
+        is_cold = compile_logic({"<": [{"var": "temp"}, 10]})
+        self.assertTrue(is_cold({"temp": 5}))
+        self.assertFalse(is_cold({"temp": 15}))
+        self.assertFalse(is_cold({"temp": 10}))
+
+    def test_compiled_nested_rule_is_reusable(self):
+        missing = compile_logic({
+            "missing": {
+                "merge": [
+                    "vin",
+                    {"if": [{"var": "financing"}, ["apr", "term"], []]}
+                ]
+            }
+        })
+        self.assertEqual(
+            missing({"financing": True}), ["vin", "apr", "term"])
+        self.assertEqual(missing({"financing": False}), ["vin"])
+        self.assertEqual(
+            missing({"financing": True, "vin": "X", "apr": 3}), ["term"])
+
+    def test_compiled_rule_defaults_to_empty_data(self):
+        self.assertEqual(compile_logic({"var": ["a", 1]})(), 1)
+        self.assertEqual(compile_logic({"missing": ["a"]})(), ["a"])
+
+    def test_compiled_primitive_is_returned(self):
+        self.assertEqual(compile_logic("apple")({"a": 1}), "apple")
+        self.assertEqual(compile_logic([1, 2])(), [1, 2])
+
+    def test_compiled_rule_only_evaluates_needed_arguments(self):
+        # Dividing by zero would raise if it was ever evaluated.
+        fail = {"/": [1, 0]}
+        self.assertEqual(compile_logic({"if": [True, "yes", fail]})(), "yes")
+        self.assertEqual(
+            compile_logic({"if": [False, fail, True, "yes", fail]})(), "yes")
+        self.assertEqual(compile_logic({"?:": [False, fail, "no"]})(), "no")
+        self.assertEqual(compile_logic({"and": [True, 0, fail]})(), 0)
+        self.assertEqual(compile_logic({"or": [False, "a", fail]})(), "a")
+
+    def test_compiled_rule_with_constant_parts(self):
+        add = compile_logic({"+": [{"var": "a"}, {"*": [2, 3]}]})
+        self.assertEqual(add({"a": 1}), 7)
+        # Constant logic that fails still only fails when it's evaluated.
+        divide = compile_logic({"if": [{"var": "a"}, {"/": [1, 0]}, 1]})
+        self.assertEqual(divide({"a": False}), 1)
+        self.assertRaises(ZeroDivisionError, divide, {"a": True})
+        # Results that are lists or objects are still built afresh on every
+        # evaluation, whether computed, literal or a var default.
+        merge = compile_logic({"merge": [1, 2]})
+        merge().append(3)
+        self.assertEqual(merge(), [1, 2])
+        literal = compile_logic({"if": [{"var": "a"}, [1, [2]], {}]})
+        literal({"a": True})[1].append(3)
+        literal({"a": False})["b"] = 1
+        self.assertEqual(literal({"a": True}), [1, [2]])
+        self.assertEqual(literal({"a": False}), {})
+        default = compile_logic({"var": ["a", [1]]})
+        default().append(2)
+        self.assertEqual(default(), [1])
+
+    def test_compiled_rule_with_constant_conditions(self):
+        fail = {"/": [1, 0]}
+        pick = compile_logic(
+            {"if": [False, fail, {"var": "a"}, "a", True, "yes", fail]})
+        self.assertEqual(pick({"a": 1}), "a")
+        self.assertEqual(pick({"a": 0}), "yes")
+        self.assertIsNone(compile_logic({"if": [False, fail]})())
+        both = compile_logic({"and": [True, {"var": "a"}, 1, {"var": "b"}]})
+        self.assertEqual(both({"a": 0, "b": 2}), 0)
+        self.assertEqual(both({"a": 1, "b": 2}), 2)
+        either = compile_logic({"or": [0, {"var": "a"}, "", {"var": "b"}]})
+        self.assertEqual(either({"a": 0, "b": ""}), "")
+        self.assertEqual(either({"a": 0, "b": 2}), 2)
+        # A constant condition makes the whole rule constant.
+        self.assertEqual(compile_logic(
+            {"+": [{"and": [0, {"var": "a"}]}, {"?:": [1, 2, fail]}]})(), 2)
+
+    def test_compiled_tests_in_any_order(self):
+        nested = {"or": [{"==": [{"var": "a"}, 1]}, {"!": {"var": "b"}}]}
+        both = compile_logic({"and": [nested, {"===": [{"var": "c"}, "x"]}]})
+        self.assertTrue(both({"a": 1, "c": "x"}))
+        self.assertFalse(both({"a": 1, "b": 1, "c": "y"}))
+        self.assertFalse(both({"a": 2, "b": 1, "c": "x"}))
+        # With an argument that isn't a bool the order matters, so is kept.
+        first = compile_logic({"and": [nested, {"var": "c"}]})
+        self.assertEqual(first({"a": 2, "b": 1, "c": "x"}), False)
+        self.assertEqual(first({"a": 1, "c": ""}), "")
+
+    def test_compiled_var_paths(self):
+        name = compile_logic({"var": ["champ.name", "nobody"]})
+        self.assertEqual(name({"champ": {"name": "Fezzig"}}), "Fezzig")
+        self.assertEqual(name({"champ": {}}), "nobody")
+        self.assertEqual(name({"champ": "Fezzig"}), "nobody")
+        self.assertEqual(name({"champ": None}), "nobody")
+        self.assertEqual(name(["champ"]), "nobody")
+        second = compile_logic({"var": "fruit.1"})
+        self.assertEqual(second({"fruit": ["apple", "banana"]}), "banana")
+        self.assertEqual(second({"fruit": {"1": "banana"}}), "banana")
+
+    def test_compiled_equality_with_constant(self):
+        is_one = compile_logic({"==": ["1", {"var": "a"}]})
+        self.assertTrue(is_one({"a": 1}))
+        self.assertTrue(is_one({"a": "1"}))
+        self.assertFalse(is_one({"a": 1.5}))
+        is_exactly_one = compile_logic({"===": [{"var": "a"}, 1]})
+        self.assertTrue(is_exactly_one({"a": 1}))
+        self.assertFalse(is_exactly_one({"a": "1"}))
+        self.assertFalse(is_exactly_one({"a": True}))
+
+    def test_compiled_in_constant_list(self):
+        is_allowed = compile_logic(
+            {"in": [{"var": "a"}, ["x", 1, [2], True]]})
+        self.assertTrue(is_allowed({"a": "x"}))
+        self.assertTrue(is_allowed({"a": 1.0}))
+        self.assertTrue(is_allowed({"a": [2]}))
+        self.assertFalse(is_allowed({"a": "y"}))
+        self.assertFalse(is_allowed({"a": [3]}))
+        is_listed = compile_logic({"in": [{"var": "a"}, ["x", 1]]})
+        self.assertTrue(is_listed({"a": True}))
+        self.assertFalse(is_listed({"a": ["x"]}))
+
+    def test_unrecognized_operation_fails_at_compile_time(self):
+        self.assertRaises(ValueError, compile_logic, {"nope": [1]})
+
+
+def load_shared_cases(url, download=True):
+    """Returns the (logic, data, expected) cases of the shared tests."""
+    tests = load_shared_tests(url, download)
+    if tests is None:
+        return None
+    return tuple(item for item in tests if isinstance(item, list))
+
+
+def check_shared_cases(apply, cases):
+    """
+    Applies the logic of each (logic, data, expected) case to its data,
+    returning a description of every failing case.
+    """
+    failures = []
+    for logic, data, expected in cases:
+        try:
+            result = apply(logic, data)
+        except Exception as e:
+            result = e
+        if result != expected:
+            failures.append("{},  {}  =>  {}, got {!r}".format(
+                logic, data, expected, result))
+    return failures
+
+
+_compiled_shared_logic = {}
+
+
+def compile_shared_logic(logic):
+    """Compiles a shared case's logic, once for all the cases sharing it."""
+    key = json.dumps(logic, sort_keys=True)
+    if key not in _compiled_shared_logic:
+        _compiled_shared_logic[key] = compile_logic(logic)
+    return _compiled_shared_logic[key]
+
+
+def group_shared_cases(cases):
+    """
+    Groups the shared cases by their logic, as (logic, [(data, expected),
+    ...]) pairs in the order the rules first appear.
+    """
+    groups = []
+    by_logic = {}
+    for logic, data, expected in cases:
+        key = json.dumps(logic, sort_keys=True)
+        if key not in by_logic:
+            by_logic[key] = (logic, [])
+            groups.append(by_logic[key])
+        by_logic[key][1].append((data, expected))
+    return groups
+
 
 class SharedTests(unittest.TestCase):
     """This runs the tests from http://jsonlogic.com/tests.json."""
-    cnt = 0
+    url = "http://jsonlogic.com/tests.json"
+
+    # Under pytest the cases run one by one as test_shared_case instead.
+    __test__ = "pytest" not in sys.modules
+
     @classmethod
-    def create_test(cls, logic, data, expected):
-        """Adds new test to the class."""
-        def test(self):
-            """Actual test function."""
-            self.assertEqual(jsonLogic(logic, data), expected)
-        test.__doc__ = "{},  {}  =>  {}".format(logic, data, expected)
-        setattr(cls, "test_{}".format(cls.cnt), test)
-        cls.cnt += 1
-
-
-SHARED_TESTS = json.loads(
-    urlopen("http://jsonlogic.com/tests.json").read().decode('utf-8')
-)
-for item in SHARED_TESTS:
-    if isinstance(item, list):
-        SharedTests.create_test(*item)
+    def setUpClass(cls):
+        try:
+            cls.cases = load_shared_cases(cls.url)
+        except (IOError, OSError) as e:
+            raise unittest.SkipTest(
+                "Can't load the shared tests: {}".format(e))
+
+    @staticmethod
+    def apply(logic, data):
+        """Evaluates a shared case's logic."""
+        return jsonLogic(logic, data)
+
+    def test_shared(self):
+        """Runs every shared case, reporting all of the failing ones."""
+        failures = check_shared_cases(self.apply, self.cases)
+        if failures:
+            self.fail("\n".join(failures))
+
+
+class CompiledSharedTests(SharedTests):
+    """This runs the tests from tests.json through compile_logic."""
+    @staticmethod
+    def apply(logic, data):
+        """Applies a shared case's compiled logic."""
+        return compile_shared_logic(logic)(data)
+
+
+def pytest_generate_tests(metafunc):
+    """
+    Gives pytest every shared case as a test of its own, so that they are
+    reported individually and can be spread over pytest-xdist workers.
+    The cases are named after their logic and data rather than their
+    position, which keeps --last-failed working when tests.json changes.
+    The compiled tests run instead in one batch per rule, named after it.
+    Collecting never downloads the shared tests: until they are cached,
+    a single test downloads and runs all of them instead. If they can't
+    be loaded, these tests are skipped rather than keeping the rest of
+    the module from being collected.
+    """
+    if "shared_case" in metafunc.fixturenames:
+        name = "shared_case"
+    elif "shared_rule" in metafunc.fixturenames:
+        name = "shared_rule"
+    else:
+        return
+    try:
+        cases = load_shared_cases(SharedTests.url, download=False)
+    except (IOError, OSError) as e:
+        import pytest
+        skip = pytest.mark.skip(
+            reason="Can't load the shared tests: {}".format(e))
+        metafunc.parametrize(name, [pytest.param(None, marks=skip)])
+        return
+    if cases is None:
+        metafunc.parametrize(name, [None], ids=["download"])
+        return
+    if name == "shared_case":
+        metafunc.parametrize(
+            "shared_case", cases,
+            ids=lambda case: json.dumps(
+                case[:2], sort_keys=True, separators=(',', ':')))
+    else:
+        metafunc.parametrize(
+            "shared_rule", group_shared_cases(cases),
+            ids=lambda group: json.dumps(
+                group[0], sort_keys=True, separators=(',', ':')))
+
+
+def run_all_shared_cases(apply):
+    """Downloads the shared tests, then runs all of their cases."""
+    import pytest
+    try:
+        cases = load_shared_cases(SharedTests.url)
+    except (IOError, OSError) as e:
+        pytest.skip("Can't load the shared tests: {}".format(e))
+    failures = check_shared_cases(apply, cases)
+    assert not failures, "\n".join(failures)
+
+
+def test_shared_case(shared_case):
+    """Runs a single shared case under pytest."""
+    if shared_case is None:
+        return run_all_shared_cases(SharedTests.apply)
+    logic, data, expected = shared_case
+    assert jsonLogic(logic, data) == expected
+
+
+def test_compiled_shared_rule(shared_rule):
+    """
+    Runs all the shared cases of a rule through one compile_logic call
+    under pytest, reporting all of the failing ones.
+    """
+    if shared_rule is None:
+        return run_all_shared_cases(CompiledSharedTests.apply)
+    logic, cases = shared_rule
+    failures = check_shared_cases(
+        CompiledSharedTests.apply,
+        [(logic, data, expected) for data, expected in cases])
+    assert not failures, "\n".join(failures)